@@ -32,10 +32,16 @@ __author__ = "Dallan Goldblatt"
 import boto3
 import csv
 import datetime
+import io
 import json
 import os
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 aws_access_key_id = os.environ['aws_access_key_id']
 aws_secret_access_key = os.environ['aws_secret_access_key']
@@ -43,49 +49,178 @@ foursquare_client_id = os.environ['foursquare_client_id']
 foursquare_client_secret = os.environ['foursquare_client_secret']
 untappd_bucket = os.environ['untappd_bucket']
 
+# Transfer settings for csv files, using larger parts and buffers and more
+# threads than the defaults once the files grow past a few MB
+transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=16 * 1024 * 1024,
+                                 max_concurrency=16,
+                                 io_chunksize=1024 * 1024)
+
+# Maximum number of Foursquare requests that are in flight at once
+max_foursquare_workers = 20
+
+# Maximum number of files that are copied to the backup folder at once, kept
+# within the S3 client's default pool of 10 connections
+max_backup_workers = 10
+
+# Borders (longitude, latitude) of the contiguous United States with Canada from
+# the Pacific to the Atlantic and with Mexico from the Gulf to the Pacific, and
+# of Alaska with Canada from the Arctic to the Pacific and with Russia across
+# the Bering Strait, each followed to within about 0.2 degrees
+us_canada_border = [(-124.75, 48.5), (-123.25, 48.25), (-123.2, 48.7),
+                    (-123.05, 49.0), (-95.15, 49.0), (-95.15, 49.38),
+                    (-94.8, 49.3), (-94.65, 48.72), (-93.3, 48.63),
+                    (-92.0, 48.35), (-90.8, 48.1), (-89.6, 48.0),
+                    (-88.4, 48.3), (-84.8, 46.9), (-84.4, 46.5),
+                    (-84.1, 46.2), (-83.5, 45.95), (-82.5, 45.3),
+                    (-82.4, 43.0), (-82.5, 42.6), (-83.1, 42.3),
+                    (-83.15, 42.0), (-82.6, 41.7), (-80.0, 42.4),
+                    (-79.0, 42.85), (-79.05, 43.25), (-78.7, 43.63),
+                    (-76.8, 43.63), (-76.45, 44.2), (-75.8, 44.45),
+                    (-74.75, 45.0), (-71.5, 45.01), (-71.1, 45.3),
+                    (-70.8, 45.4), (-70.25, 45.95), (-70.0, 46.7),
+                    (-69.22, 47.45), (-68.3, 47.35), (-67.8, 47.07),
+                    (-67.78, 45.95), (-67.4, 45.6), (-67.0, 44.8)]
+us_mexico_border = [(-97.15, 25.95), (-99.5, 27.5), (-101.0, 29.4),
+                    (-102.4, 29.8), (-103.2, 28.97), (-104.4, 29.6),
+                    (-106.5, 31.75), (-108.2, 31.78), (-108.2, 31.33),
+                    (-111.07, 31.33), (-114.8, 32.49), (-114.72, 32.72),
+                    (-117.12, 32.53)]
+alaska_canada_border = [(-141.0, 71.5), (-141.0, 60.3), (-139.0, 60.1),
+                        (-137.5, 59.1), (-135.5, 59.8), (-133.4, 58.4),
+                        (-132.0, 57.0), (-130.0, 56.1), (-130.6, 54.7)]
+alaska_russia_border = [(-168.97, 65.5), (-168.97, 71.5)]
+us_borders = [us_canada_border, us_mexico_border,
+              alaska_canada_border, alaska_russia_border]
+
+# Coarse outlines of the contiguous United States, Alaska, and Hawaii, used when
+# Foursquare does not return a venue's country
+# Between the borders the outlines only follow the coasts closely enough to
+# leave out nearby islands of other countries, such as the Bahamas
+us_outlines = [us_canada_border
+               + [(-69.8, 41.5), (-75.3, 35.0), (-79.8, 27.5), (-79.9, 25.0),
+                  (-80.3, 24.4), (-83.0, 24.4)]
+               + us_mexico_border
+               + [(-117.3, 32.5), (-120.8, 34.3), (-124.6, 40.4)],
+               alaska_canada_border
+               + [(-133.5, 54.4), (-170.0, 51.0), (-170.0, 64.0)]
+               + alaska_russia_border,
+               [(-161.0, 18.5), (-154.5, 18.5), (-154.5, 22.5), (-161.0, 22.5)]]
+
+# Points closer than this many degrees to a border are too close to tell which
+# side they are on from the coarse outlines
+us_border_margin = 0.25
+
 def create_client(access_key_id, secret_access_key):
     """Create S3 client for later use"""
+    # Keep idle connections open between invocations
     client = boto3.client('s3',
                           aws_access_key_id=access_key_id,
-                          aws_secret_access_key=secret_access_key)
+                          aws_secret_access_key=secret_access_key,
+                          config=Config(tcp_keepalive=True))
     return client
 
+# Client for interfacing with S3, kept between invocations of a warm Lambda
+# container so its connections and setup are reused
+s3 = create_client(aws_access_key_id, aws_secret_access_key)
+
+def create_session(pool_size):
+    """Create HTTP session that reuses connections across requests and retries
+    requests that hit a temporary server error"""
+    session = requests.Session()
+    # Wait exponentially longer between retries and raise a RetryError once
+    # retries run out
+    # Rate limited requests are not retried so a rejected premium request is
+    # returned right away and stops the remaining searches, and Retry-After is
+    # ignored since it can ask to wait longer than the function can run
+    retries = Retry(total=5,
+                    backoff_factor=0.5,
+                    status_forcelist=[500, 502, 503, 504],
+                    respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+# Session shared by the threads so connections to Foursquare are reused, kept
+# between invocations of a warm Lambda container
+foursquare_session = create_session(max_foursquare_workers)
+
 def download_venue_locations(client, file):
     """Download existing csv containing venue location data"""
     client.download_file(Bucket=untappd_bucket,
                          Key='venue_locations.csv',
-                         Filename=file)
+                         Filename=file,
+                         Config=transfer_config)
 
-def upload_venue_locations(client, file):
-    """Upload venue location csv to S3"""
-    client.upload_file(Bucket=untappd_bucket,
-                       Key='venue_locations.csv',
-                       Filename=file)
+def upload_venue_locations(client, buffer):
+    """Upload venue location csv from an in-memory buffer to S3"""
+    client.upload_fileobj(Fileobj=buffer,
+                          Bucket=untappd_bucket,
+                          Key='venue_locations.csv',
+                          Config=transfer_config)
 
 def read_csv_to_dict(file):
-    """Read venue location csv into a dictionary indexed by venue name"""
-    # Get 2D list of all rows from csv
-    with open(file, "r", encoding='utf-8') as f:
+    """Read venue location csv into a dictionary mapping venue names to their
+    full csv rows"""
+    with open(file, "r", newline='', encoding='utf-8') as f:
         data = csv.reader(f)
         next(data) # skip headers
-        venue_list = list(data)
-    # Convert list to dictionary indexed by venue name
-    venue_exists = venue_list and venue_list[0]
-    return {venue:data for venue, *data in venue_list} if venue_exists else {}
-
-def write_dict_to_csv(venue_dict, file):
-    """Write venue location dictionary to the venue location csv"""
-    # Convert dictionary to 2D list of rows
-    venue_list = [[venue, *data] for venue, data in venue_dict.items()]
+        # Convert rows straight to dictionary indexed by venue name without
+        # building a list of all rows first, skipping empty rows
+        # Rows keep the venue name in column 0 so they can be written unchanged
+        return {row[0]:row for row in filter(None, data)}
+
+def write_dict_to_csv(venue_dict):
+    """Write venue location dictionary to an in-memory csv buffer"""
     headers = ['venue', 'untappd_url', 'foursquare_url', 'address',
                'lat', 'long', 'categories', 'in_united_states']
-    # Write rows to csv, overwriting old data since order is not guaranteed
-    with open(file, "w", newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        # Write headers
-        writer.writerow(headers)
-        # Write venue data
-        writer.writerows(venue_list)
+    # Encode rows straight into the buffer that will be uploaded instead of
+    # writing them to /tmp and reading them back
+    buffer = io.BytesIO()
+    f = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+    writer = csv.writer(f)
+    # Write headers
+    writer.writerow(headers)
+    # Write venue data, the dictionary values are already full rows
+    writer.writerows(venue_dict.values())
+    # Detach the text wrapper so the buffer stays open for uploading
+    f.detach()
+    buffer.seek(0)
+    return buffer
+
+def in_polygon(lng, lat, polygon):
+    """Check if a point is inside a polygon by counting the edges crossed by a
+    ray from the point"""
+    inside = False
+    for (x1, y1), (x2, y2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (y1 > lat) != (y2 > lat):
+            if lng < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+    return inside
+
+def distance_to_border(lng, lat, border):
+    """Get distance in degrees from a point to the closest segment of a border"""
+    distances = []
+    for (x1, y1), (x2, y2) in zip(border, border[1:]):
+        dx, dy = x2 - x1, y2 - y1
+        # Position of the closest point along the segment, from 0 to 1
+        t = max(0, min(1, ((lng - x1) * dx + (lat - y1) * dy) / (dx * dx + dy * dy)))
+        distances.append(((lng - x1 - t * dx) ** 2 + (lat - y1 - t * dy) ** 2) ** 0.5)
+    return min(distances)
+
+def estimate_in_us(lat, lng):
+    """Estimate if coordinates are in the United States from outlines"""
+    try:
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError): # Coordinates are missing
+        return 'Unavailable'
+    if any(distance_to_border(lng, lat, border) < us_border_margin
+           for border in us_borders):
+        # Too close to a border to estimate
+        return 'Unavailable'
+    return any(in_polygon(lng, lat, outline) for outline in us_outlines)
 
 def safe_dict(dict_name, key):
     """Utility function for handling missing keys in dictionary"""
@@ -94,25 +229,21 @@ def safe_dict(dict_name, key):
     except KeyError:
         return 'Unavailable'
         
-def search_foursquare(foursquare_url, coords, foursquare_client_id, foursquare_client_secret):
+def search_foursquare(session, venue_id, coords):
     """Get address data list for a venue details request to Foursquare API"""
-    # Unpack data from venue_info
-    venue_id = foursquare_url.split('/')[-1]
-    # Query Foursquare API for venue
+    # Query Foursquare API for venue, the session sends the version and keys
     search_url = 'https://api.foursquare.com/v2/venues/' + venue_id
-    params = dict(v=time.strftime('%Y%m%d'),
-                  client_id=foursquare_client_id,
-                  client_secret=foursquare_client_secret)
-    with requests.get(url=search_url, params=params) as query:
-        if query.status_code == 400:
-            # Param Error indicates venue id no longer exists
-            return ['Unavailable', *coords, 'Unavailable', 'Unavailable']
-        elif query.status_code != 200:
-            print('Foursquare request returned status code:',
-                query.status_code, '\n\t', query.reason)
-            return ['Missing', *coords, 'Missing', 'Missing'] # Try again later
-        else:
-            data = json.loads(query.text)
+    try:
+        with session.get(url=search_url) as query:
+            if query.status_code == 400:
+                # Param Error indicates venue id no longer exists
+                return ['Unavailable', *coords, 'Unavailable', 'Unavailable']
+            query.raise_for_status()
+            data = json.loads(query.content)
+    except requests.exceptions.RequestException as e:
+        # Request still failed after retrying
+        print('Foursquare request failed:\n\t', e)
+        return ['Missing', *coords, 'Missing', 'Missing'] # Try again later
     try:
         # Extract missing data returned by requst
         venue = data['response']['venue']['location']
@@ -135,68 +266,109 @@ def search_foursquare(foursquare_url, coords, foursquare_client_id, foursquare_c
         row.append('Uncategorized')
     # Check if location is in United States
     country = safe_dict(venue, 'country')
-    in_us = 'Unavailable' if country == 'Unavailable' else country == 'United States'
+    if country == 'Unavailable':
+        # Fall back to checking the coordinates
+        in_us = estimate_in_us(row[1], row[2])
+    else:
+        in_us = country == 'United States'
     row.append(in_us)
     return row
 
+def backup_file(client, file, today):
+    """Copy a file to the backup folder labelled with the date"""
+    try:
+        client.copy_object(Bucket=untappd_bucket,
+                           CopySource=f'untappd-rss-feed-data/{file}',
+                           Key=f'Backups/{today}/{file}')
+    except client.exceptions.NoSuchKey:
+        # File has not been created yet, such as venue_set.json before the
+        # parse function first saves it
+        print(f'Skipped backup of missing file {file}')
+
 def create_backup(client):
     """Create backup of all files needed for Lambda function execution other than post data"""
     today = datetime.date.today().strftime("%Y-%m-%d")
     last_week = (datetime.date.today() - datetime.timedelta(days=7)).strftime("%Y-%m-%d")
-    last_week2 = (datetime.date.today() - datetime.timedelta(days=8)).strftime("%Y-%m-%d")
-    file_list = ['last_parsed.json', 'last_update.json', 'untappd_aggregate_data.csv',
-                 'venue_list.csv', 'venue_locations.csv']
+    file_list = ['last_update.json', 'untappd_aggregate_data.csv',
+                 'venue_list.csv', 'venue_set.json', 'venue_locations.csv']
+    # Add the last parsed file for each brewery, along with the single last
+    # parsed file used before them if it still exists
+    resp = client.list_objects_v2(Bucket=untappd_bucket, Prefix='last_parsed')
+    file_list += [obj['Key'] for obj in resp.get('Contents', [])]
     
-    # Copy current files to new backup folder
-    for file in file_list:
-        client.copy_object(Bucket=untappd_bucket,
-                           CopySource=f'untappd-rss-feed-data/{file}',
-                           Key=f'Backups/{today}/{file}')
+    # Copy current files to new backup folder, copying all files at once
+    with ThreadPoolExecutor(max_workers=min(len(file_list),
+                                            max_backup_workers)) as executor:
+        list(executor.map(lambda file: backup_file(client, file, today),
+                          file_list))
     
-    # Delete backup from one week ago (and 8 days ago if it exists)
-    keys_to_delete = {'Objects': [{'Key': f'Backups/{last_week}/{file}'} for file in file_list]}
-    client.delete_objects(Bucket=untappd_bucket, Delete=keys_to_delete)
-    keys_to_delete2 = {'Objects': [{'Key': f'Backups/{last_week2}/{file}'} for file in file_list]}
-    client.delete_objects(Bucket=untappd_bucket, Delete=keys_to_delete2)
+    # Delete backups from one week ago or earlier in one request, listing the
+    # backup folders so any older backups that were missed are deleted too
+    resp = client.list_objects_v2(Bucket=untappd_bucket, Prefix='Backups/')
+    old_keys = [{'Key': obj['Key']} for obj in resp.get('Contents', [])
+                if '' < obj['Key'].split('/')[1] <= last_week]
+    if old_keys:
+        # Quiet mode leaves successfully deleted keys out of the response
+        keys_to_delete = {'Objects': old_keys, 'Quiet': True}
+        client.delete_objects(Bucket=untappd_bucket, Delete=keys_to_delete)
 
 def main():
     """Use premium Foursquare API calls to fix missing data and backup non-post files in S3"""
     # Temp directory for csv
     venue_locations_file = '/tmp/venue_locations.csv'
 
-    # Create client for interfacing with S3
-    s3 = create_client(aws_access_key_id, aws_secret_access_key)
-
     # Download existing venue location data csv
     download_venue_locations(s3, venue_locations_file)
 
     # Convert venue location data to a searchable dictionary
     venue_dict = read_csv_to_dict(venue_locations_file)
     
-    # Find rows with missing data and attempt to fill in
-    for venue, venue_data in venue_dict.items():
-        foursquare_url = venue_data[1]
-        coords = [venue_data[3], venue_data[4]]
-        # Skip rows where all data is present or if Foursquare url is missing
-        if 'Missing' not in venue_data or foursquare_url == 'Missing':
-            continue
-        # Use premium Foursquare API calls to get details of venue by ID
-        venue_dict[venue][-5:] = search_foursquare(foursquare_url,
-                                                   coords,
-                                                   foursquare_client_id,
-                                                   foursquare_client_secret)
-        if venue_dict[venue][3] == 'Missing':
-            # Foursquare rejected request, stop searching Foursquare
-            break
-    
-    # Write venue location dictionary back to csv
-    write_dict_to_csv(venue_dict, venue_locations_file)
+    # Find rows with missing data, skipping rows where all data is present or
+    # if Foursquare url is missing, and pull the venue id from each url once
+    missing_venues = {venue: venue_data[2].rsplit('/', 1)[-1]
+                      for venue, venue_data in venue_dict.items()
+                      if 'Missing' in venue_data[1:] and venue_data[2] != 'Missing'}
+
+    # Send the Foursquare API version and keys with every request
+    foursquare_session.params = dict(v=time.strftime('%Y%m%d'),
+                                     client_id=foursquare_client_id,
+                                     client_secret=foursquare_client_secret)
+
+    # Use premium Foursquare API calls to get details of venues by ID
+    # Requests are run concurrently since they spend most of their time waiting
+    with ThreadPoolExecutor(max_workers=max_foursquare_workers) as executor:
+        futures = {executor.submit(search_foursquare,
+                                   foursquare_session,
+                                   venue_id,
+                                   venue_dict[venue][4:6]): venue
+                   for venue, venue_id in missing_venues.items()}
+        foursquare_available = True
+        # Track if any venue data changed so an unchanged csv is not uploaded
+        modified = False
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            venue = futures[future]
+            venue_data = future.result()
+            if venue_data != venue_dict[venue][-5:]:
+                venue_dict[venue][-5:] = venue_data
+                modified = True
+            if foursquare_available and venue_data[0] == 'Missing':
+                # Foursquare rejected request, stop searching Foursquare
+                foursquare_available = False
+                for pending in futures:
+                    pending.cancel()
     
-    # Upload new venue location data
-    upload_venue_locations(s3, venue_locations_file)
+    if modified:
+        # Write venue location dictionary back to csv
+        venue_locations_csv = write_dict_to_csv(venue_dict)
+
+        # Upload new venue location data
+        upload_venue_locations(s3, venue_locations_csv)
     
     # Create backup of all non-post files so operation can be restored from an 
-    # earlier date if Lambda functions produce erroneous data 
+    # earlier date if Lambda functions produce erroneous data, copying the
+    # existing venue location csv in S3 if it was not changed
     create_backup(s3)
     
 def lambda_handler(event, context):
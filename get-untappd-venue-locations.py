@@ -29,13 +29,22 @@ Automatic Triggering:
 __author__ = "Dallan Goldblatt"
 
 import boto3
+import codecs
 import csv
 import json
 import os
 import random
+import re
 import requests
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from html.parser import HTMLParser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 # Get environment variables
 aws_access_key_id = os.environ['aws_access_key_id']
@@ -44,6 +53,13 @@ foursquare_client_id = os.environ['foursquare_client_id']
 foursquare_client_secret = os.environ['foursquare_client_secret']
 untappd_bucket = os.environ['untappd_bucket']
 
+# Transfer settings for csv files, using larger parts and buffers and more
+# threads than the defaults once the files grow past a few MB
+transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=16 * 1024 * 1024,
+                                 max_concurrency=16,
+                                 io_chunksize=1024 * 1024)
+
 user_agents = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.169 Safari/537.36',
                    'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/72.0.3626.121 Safari/537.36',
                    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.157 Safari/537.36',
@@ -52,6 +68,92 @@ user_agents = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KH
                    'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1)',
                    'Mozilla/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko']
 
+# Maximum number of Untappd venues that are searched at once
+max_untappd_workers = 8
+
+class RateLimiter:
+    """Token bucket shared between threads that allows a number of calls in
+    each period of about the given number of seconds"""
+    def __init__(self, calls, period):
+        self.calls = calls
+        self.period = period
+        self.lock = threading.Lock()
+        self.timestamps = deque()
+    def wait(self):
+        # Holding the lock while sleeping makes later callers queue up in order
+        with self.lock:
+            if len(self.timestamps) == self.calls:
+                # Wait for the oldest call to leave the period, randomised to
+                # avoid a regular pattern of requests
+                delay = (self.timestamps.popleft() + self.period
+                         + random.uniform(-1, 1) - time.monotonic())
+                if delay > 0:
+                    time.sleep(delay)
+            self.timestamps.append(time.monotonic())
+
+# Maximum number of requests sent to Untappd by all workers combined in each
+# period of about 4 seconds. Searching a venue takes two requests, and searching
+# one venue every 4 seconds is the rate that was used when venues were searched
+# one at a time without Untappd rejecting requests, so the workers together are
+# kept to that rate rather than multiplying it
+untappd_requests_per_period = 2
+untappd_rate_period = 4
+untappd_rate_limiter = RateLimiter(untappd_requests_per_period,
+                                   untappd_rate_period)
+
+# Borders (longitude, latitude) of the contiguous United States with Canada from
+# the Pacific to the Atlantic and with Mexico from the Gulf to the Pacific, and
+# of Alaska with Canada from the Arctic to the Pacific and with Russia across
+# the Bering Strait, each followed to within about 0.2 degrees
+us_canada_border = [(-124.75, 48.5), (-123.25, 48.25), (-123.2, 48.7),
+                    (-123.05, 49.0), (-95.15, 49.0), (-95.15, 49.38),
+                    (-94.8, 49.3), (-94.65, 48.72), (-93.3, 48.63),
+                    (-92.0, 48.35), (-90.8, 48.1), (-89.6, 48.0),
+                    (-88.4, 48.3), (-84.8, 46.9), (-84.4, 46.5),
+                    (-84.1, 46.2), (-83.5, 45.95), (-82.5, 45.3),
+                    (-82.4, 43.0), (-82.5, 42.6), (-83.1, 42.3),
+                    (-83.15, 42.0), (-82.6, 41.7), (-80.0, 42.4),
+                    (-79.0, 42.85), (-79.05, 43.25), (-78.7, 43.63),
+                    (-76.8, 43.63), (-76.45, 44.2), (-75.8, 44.45),
+                    (-74.75, 45.0), (-71.5, 45.01), (-71.1, 45.3),
+                    (-70.8, 45.4), (-70.25, 45.95), (-70.0, 46.7),
+                    (-69.22, 47.45), (-68.3, 47.35), (-67.8, 47.07),
+                    (-67.78, 45.95), (-67.4, 45.6), (-67.0, 44.8)]
+us_mexico_border = [(-97.15, 25.95), (-99.5, 27.5), (-101.0, 29.4),
+                    (-102.4, 29.8), (-103.2, 28.97), (-104.4, 29.6),
+                    (-106.5, 31.75), (-108.2, 31.78), (-108.2, 31.33),
+                    (-111.07, 31.33), (-114.8, 32.49), (-114.72, 32.72),
+                    (-117.12, 32.53)]
+alaska_canada_border = [(-141.0, 71.5), (-141.0, 60.3), (-139.0, 60.1),
+                        (-137.5, 59.1), (-135.5, 59.8), (-133.4, 58.4),
+                        (-132.0, 57.0), (-130.0, 56.1), (-130.6, 54.7)]
+alaska_russia_border = [(-168.97, 65.5), (-168.97, 71.5)]
+us_borders = [us_canada_border, us_mexico_border,
+              alaska_canada_border, alaska_russia_border]
+
+# Coarse outlines of the contiguous United States, Alaska, and Hawaii, used when
+# Foursquare does not return a venue's country
+# Between the borders the outlines only follow the coasts closely enough to
+# leave out nearby islands of other countries, such as the Bahamas
+us_outlines = [us_canada_border
+               + [(-69.8, 41.5), (-75.3, 35.0), (-79.8, 27.5), (-79.9, 25.0),
+                  (-80.3, 24.4), (-83.0, 24.4)]
+               + us_mexico_border
+               + [(-117.3, 32.5), (-120.8, 34.3), (-124.6, 40.4)],
+               alaska_canada_border
+               + [(-133.5, 54.4), (-170.0, 51.0), (-170.0, 64.0)]
+               + alaska_russia_border,
+               [(-161.0, 18.5), (-154.5, 18.5), (-154.5, 22.5), (-161.0, 22.5)]]
+
+# Points closer than this many degrees to a border are too close to tell which
+# side they are on from the coarse outlines
+us_border_margin = 0.25
+
+# Classes of the tags containing the venue link on checkin pages and the
+# Foursquare link on venue pages, used to skip parsing pages without them
+location_class_re = re.compile(r'class=["\']location["\']')
+venue_social_class_re = re.compile(r'class=["\']venue-social["\']')
+
 class CheckinHTMLParser(HTMLParser):
     """HTMLParser for reading the venue link from the Untappd checkin page"""
     def __init__(self):
@@ -78,6 +180,8 @@ class CheckinHTMLParser(HTMLParser):
             self.found_p = False
     def handle_data(self, data):
         pass
+    def done(self):
+        return bool(self.url)
 
 class VenueHTMLParser(HTMLParser):
     """HTMLParser for reading the Foursquare link and venue coordinates from the
@@ -92,76 +196,156 @@ class VenueHTMLParser(HTMLParser):
         # tag with 'venue-social' as its class
         # The venue coordinates are found in 'meta' tags with 'property' set
         # to 'place:location:latitude' and 'place:location:longitude'
-        if tag not in ['div', 'a', 'meta']:
-            return
-        attributes_dict = dict(attributes)
-        if tag == 'meta' and 'property' in attributes_dict:
-            if attributes_dict['property'] in ['place:location:latitude',
-                                               'place:location:longitude']:
-                self.coords.append(attributes_dict['content'])
-            return
-        if 'class' not in attributes_dict:
-            return
-        if (not self.found_div and tag == 'div' 
-            and attributes_dict['class'] == 'venue-social'):
-            self.found_div = True
-            return
-        if (self.found_div and tag == 'a' 
-            and attributes_dict['class'] == 'fs track-click'):
-            self.urls.append(attributes_dict['href'].split('?')[0])
-            return
+        # Attributes are scanned directly instead of building a dictionary
+        # for every tag since most tags are not the ones being searched for
+        if tag == 'meta':
+            prop = content = None
+            for name, value in attributes:
+                if name == 'property':
+                    prop = value
+                elif name == 'content':
+                    content = value
+            if prop in ('place:location:latitude', 'place:location:longitude'):
+                self.coords.append(content)
+        elif tag == 'div' and not self.found_div:
+            for name, value in attributes:
+                if name == 'class' and value == 'venue-social':
+                    self.found_div = True
+                    return
+        elif tag == 'a' and self.found_div:
+            class_name = href = None
+            for name, value in attributes:
+                if name == 'class':
+                    class_name = value
+                elif name == 'href':
+                    href = value
+            if class_name == 'fs track-click' and href:
+                self.urls.append(href.split('?')[0])
     def handle_endtag(self, tag):
         if tag == 'div':
             self.found_div = False
     def handle_data(self, data):
         pass
+    def done(self):
+        return bool(self.urls) and len(self.coords) >= 2
+
+def feed_until_done(parser, htmlstring, chunk_size=16384):
+    """Feed html to parser in chunks, skipping the rest of the page once the
+    parser has found everything it is looking for"""
+    for start in range(0, len(htmlstring), chunk_size):
+        parser.feed(htmlstring[start:start + chunk_size])
+        if parser.done():
+            break
 
 def create_client(access_key_id, secret_access_key):
     """Create S3 client for later use"""
+    # Keep idle connections open between invocations
     client = boto3.client('s3',
                           aws_access_key_id=access_key_id,
-                          aws_secret_access_key=secret_access_key)
+                          aws_secret_access_key=secret_access_key,
+                          config=Config(tcp_keepalive=True))
     return client
 
-def get_venue_list(client):
-    """Get list of venue names from existing csv in S3"""
+# Client for interfacing with S3, kept between invocations of a warm Lambda
+# container so its connections and setup are reused
+s3 = create_client(aws_access_key_id, aws_secret_access_key)
+
+def create_session(pool_size):
+    """Create HTTP session that reuses connections across requests and retries
+    requests that hit a temporary server error"""
+    session = requests.Session()
+    # Wait exponentially longer between retries and raise a RetryError once
+    # retries run out
+    # Rate limited requests are not retried so a rejected request is returned
+    # right away and stops the remaining searches, and Retry-After is ignored
+    # since it can ask to wait longer than the function can run
+    retries = Retry(total=5,
+                    backoff_factor=0.5,
+                    status_forcelist=[500, 502, 503, 504],
+                    respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+# Sessions that reuse connections to Untappd and Foursquare, kept between
+# invocations of a warm Lambda container
+# The Untappd session is shared by the threads searching Untappd
+untappd_session = create_session(16)
+foursquare_session = create_session(1)
+
+def iter_venue_list(client):
+    """Yield venue names and checkin links from existing csv in S3"""
     sb = client.get_object(Bucket=untappd_bucket,
                            Key='venue_list.csv')['Body']
-    # sb is a StreamingBody which needs to be decoded into a csv format
-    f = sb.read().decode('utf-8').splitlines(True)
-    # Read list of all venues from csv
-    data = csv.reader(f)
+    # sb is a StreamingBody which is decoded line by line as it is read instead
+    # of reading the whole csv into memory
+    data = csv.reader(codecs.getreader('utf-8')(sb))
     next(data) # skip header
-    # Convert data to list of rows
-    return list(data)
+    yield from data
+
+def get_venue_locations_etag(client):
+    """Get ETag of the venue location csv in S3"""
+    return client.head_object(Bucket=untappd_bucket,
+                              Key='venue_locations.csv')['ETag']
+
+def read_etag(file):
+    """Read ETag of the S3 object that the local file is a copy of"""
+    try:
+        with open(file + '.etag', "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def write_etag(file, etag):
+    """Record ETag of the S3 object that the local file is a copy of, None if
+    the local file no longer matches S3"""
+    if etag is None:
+        try:
+            os.remove(file + '.etag')
+        except FileNotFoundError:
+            pass
+        return
+    with open(file + '.etag', "w") as f:
+        f.write(etag)
 
 def download_venue_locations(client, file):
     """Download existing csv containing venue location data"""
+    # /tmp is kept between invocations of a warm Lambda container, so skip the
+    # download if the local copy matches the csv in S3
+    etag = get_venue_locations_etag(client)
+    if os.path.exists(file) and read_etag(file) == etag:
+        return
+    write_etag(file, None)
     client.download_file(Bucket=untappd_bucket,
                          Key='venue_locations.csv',
-                         Filename=file)
+                         Filename=file,
+                         Config=transfer_config)
+    write_etag(file, etag)
 
 def upload_venue_locations(client, file):
     """Upload venue location csv to S3"""
     client.upload_file(Bucket=untappd_bucket,
                        Key='venue_locations.csv',
-                       Filename=file)
+                       Filename=file,
+                       Config=transfer_config)
+    # Local copy now matches S3 and can be reused by the next invocation
+    write_etag(file, get_venue_locations_etag(client))
 
 def read_csv_to_dict(file):
-    """Read venue location csv into a dictionary indexed by venue name"""
-    # Get 2D list of all rows from csv
-    with open(file, "r", encoding='utf-8') as f:
+    """Read venue location csv into a dictionary mapping venue names to their
+    full csv rows"""
+    with open(file, "r", newline='', encoding='utf-8') as f:
         data = csv.reader(f)
         next(data) # skip headers
-        venue_list = list(data)
-    # Convert list to dictionary indexed by venue name
-    venue_exists = venue_list and venue_list[0]
-    return {venue:data for venue, *data in venue_list} if venue_exists else {}
+        # Convert rows straight to dictionary indexed by venue name without
+        # building a list of all rows first, skipping empty rows
+        # Rows keep the venue name in column 0 so they can be written unchanged
+        return {row[0]:row for row in filter(None, data)}
 
 def write_dict_to_csv(venue_dict, file):
     """Write venue location dictionary to the venue location csv"""
-    # Convert dictionary to 2D list of rows
-    venue_list = [[venue, *data] for venue, data in venue_dict.items()]
     headers = ['venue', 'untappd_url', 'foursquare_url', 'address',
                'lat', 'long', 'categories', 'in_united_states']
     # Write rows to csv, overwriting old data since order is not guaranteed
@@ -169,29 +353,44 @@ def write_dict_to_csv(venue_dict, file):
         writer = csv.writer(f)
         # Write headers
         writer.writerow(headers)
-        # Write venue data
-        writer.writerows(venue_list)
+        # Write venue data, the dictionary values are already full rows
+        writer.writerows(venue_dict.values())
 
-def search_untappd(checkin_url):
+def get_untappd_html(session, url, headers):
+    """Get html for an Untappd page, None if the page does not exist"""
+    # Wait for the shared rate limiter before every request to Untappd
+    untappd_rate_limiter.wait()
+    with session.get(url, headers=headers) as response:
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.text
+
+def search_untappd(session, checkin_url):
     """Get Foursquare venue url and venue coordinates from from following venue 
     link on Untappd checkin"""
     # Set User-Agent header to simulate requests coming from different browsers
     headers = {'User-Agent': random.choice(user_agents),
                'Content-Type': 'text/html'}
     # Get html for checkin page using Untappd checkin url
-    with requests.get(checkin_url, headers=headers) as response:
-        if response.status_code == 404:
-            # Checkin was deleted by user
-            return ['Missing'] * 5 # Do not try again later
-        if response.status_code != 200:
-            # Handle unexpected errors
-            print('Untappd request returned status code:', response.status_code,
-                  '\n\t', response.reason)
-            return [''] * 5 # Try again later
-        htmlstring = response.text
-    # Feed html as text to parser to get Untappd venue url
+    try:
+        htmlstring = get_untappd_html(session, checkin_url, headers)
+    except requests.exceptions.RequestException as e:
+        # Handle unexpected errors that remain after retrying
+        print('Untappd request failed:\n\t', e)
+        return [''] * 5 # Try again later
+    if htmlstring is None:
+        # Checkin was deleted by user
+        return ['Missing'] * 5 # Do not try again later
+    location_match = location_class_re.search(htmlstring)
+    if not location_match:
+        # Checkin location tag was deleted by user
+        return ['Missing'] * 5 # Do not try again later
+    # Feed html as text to parser to get Untappd venue url, starting from the
+    # tag with the location class
+    start = max(htmlstring.rfind('<', 0, location_match.start()), 0)
     parser = CheckinHTMLParser()
-    parser.feed(htmlstring)
+    feed_until_done(parser, htmlstring[start:])
     # Extract Untappd venue url from parser if it exists
     if not parser.url:
         # Checkin location tag was deleted by user
@@ -199,18 +398,20 @@ def search_untappd(checkin_url):
     untappd_venue_url = 'https://untappd.com' + parser.url[0]
 
     # Get html for venue page using Untappd venue url
-    with requests.get(untappd_venue_url, headers=headers) as response:
-        if response.status_code == 404:
-            # Venue was deleted or merged with a different venue url
-             return ['Missing'] * 5 # Do not try again later
-        if response.status_code != 200:
-            print('Untappd request returned status code:', response.status_code,
-                  '\n\t', response.reason)
-            return [''] * 5 # Try again later
-        htmlstring = response.text
+    try:
+        htmlstring = get_untappd_html(session, untappd_venue_url, headers)
+    except requests.exceptions.RequestException as e:
+        print('Untappd request failed:\n\t', e)
+        return [''] * 5 # Try again later
+    if htmlstring is None:
+        # Venue was deleted or merged with a different venue url
+        return ['Missing'] * 5 # Do not try again later
+    if not venue_social_class_re.search(htmlstring):
+        # Do not try again later since Untappd was missing data
+        return ['Missing'] * 5
     # Feed html as text to parser to get Foursquare venue url
     parser = VenueHTMLParser()
-    parser.feed(htmlstring)
+    feed_until_done(parser, htmlstring)
     # Extract data from parser, may have more than one link (desktop and mobile)
     foursquare_venue_urls = parser.urls
     coords = parser.coords
@@ -221,33 +422,64 @@ def search_untappd(checkin_url):
         # Do not try again later since Untappd was missing data
         return ['Missing'] * 5
 
-def search_foursquare(venue, venue_info, foursquare_client_id, foursquare_client_secret):
+def in_polygon(lng, lat, polygon):
+    """Check if a point is inside a polygon by counting the edges crossed by a
+    ray from the point"""
+    inside = False
+    for (x1, y1), (x2, y2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (y1 > lat) != (y2 > lat):
+            if lng < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+    return inside
+
+def distance_to_border(lng, lat, border):
+    """Get distance in degrees from a point to the closest segment of a border"""
+    distances = []
+    for (x1, y1), (x2, y2) in zip(border, border[1:]):
+        dx, dy = x2 - x1, y2 - y1
+        # Position of the closest point along the segment, from 0 to 1
+        t = max(0, min(1, ((lng - x1) * dx + (lat - y1) * dy) / (dx * dx + dy * dy)))
+        distances.append(((lng - x1 - t * dx) ** 2 + (lat - y1 - t * dy) ** 2) ** 0.5)
+    return min(distances)
+
+def estimate_in_us(lat, lng):
+    """Estimate if coordinates are in the United States from outlines"""
+    try:
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError): # Coordinates are missing
+        return 'Unavailable'
+    if any(distance_to_border(lng, lat, border) < us_border_margin
+           for border in us_borders):
+        # Too close to a border to estimate
+        return 'Unavailable'
+    return any(in_polygon(lng, lat, outline) for outline in us_outlines)
+
+def search_foursquare(session, venue, venue_info):
     """Get address data list for a venue search from Foursquare"""
     # Unpack data from venue_info
-    venue_url = venue_info[1]
-    coords = [venue_info[3], venue_info[4]]
+    venue_url = venue_info[2]
+    coords = [venue_info[4], venue_info[5]]
     # Handle when Untappd could not find a location
     if venue_url == 'Missing':
         return ['Missing'] * 5
     # Pull venue id from url
-    venue_id = venue_url.split('/')[-1]
-    # Query Foursquare API for venue using data from Untappd
+    venue_id = venue_url.rsplit('/', 1)[-1]
+    # Query Foursquare API for venue using data from Untappd, the session sends
+    # the version and keys
     search_url = 'https://api.foursquare.com/v2/venues/search'
     params = dict(intent='browse',
                   query=venue,
                   ll=','.join(coords),
                   radius=25000,
-                  limit=10,
-                  v=time.strftime('%Y%m%d'),
-                  client_id=foursquare_client_id,
-                  client_secret=foursquare_client_secret)
-    with requests.get(url=search_url, params=params) as query:
-        if query.status_code != 200:
-            print('Foursquare request returned status code:',
-                query.status_code, '\n\t', query.reason)
-            return ['', *coords, '', ''] # Try again later
-        else:
-            data = json.loads(query.text)
+                  limit=10)
+    try:
+        with session.get(url=search_url, params=params) as query:
+            query.raise_for_status()
+            data = json.loads(query.content)
+    except requests.exceptions.RequestException as e:
+        # Request still failed after retrying
+        print('Foursquare request failed:\n\t', e)
+        return ['', *coords, '', ''] # Try again later
     # Get list of venues returned by search (up to 10)
     venue_list = data['response']['venues']
     for venue_item in venue_list:
@@ -271,77 +503,112 @@ def search_foursquare(venue, venue_info, foursquare_client_id, foursquare_client
                 row.append(', '.join(str(c) for c in category_list))
             else: # Indicate there are no categories
                 row.append('Uncategorized')
-            # Check if location is in United States
-            row.append(venue['country'] == 'United States')
+            # Check if location is in United States, falling back to checking
+            # the coordinates if the country is missing
+            if 'country' in venue:
+                row.append(venue['country'] == 'United States')
+            else:
+                row.append(estimate_in_us(venue['lat'], venue['lng']))
             return row
         except KeyError: # KeyError if address is set to private, return Missing
             pass
     # No matching venues were returned from search, do not try again
     return ['Missing', *coords, 'Missing', 'Missing']
 
-def backup_data(s3, venue_dict, venue_locations_file):
-    """Write venue locations dictionary to the csv file and upload it to S3"""
-    # Write venue location dictionary to csv file
+def backup_data(s3, venue_dict, venue_locations_file, updated_venues):
+    """Write venue locations dictionary to the csv file and upload it to S3 if
+    any venues were updated since the last backup"""
+    if not updated_venues:
+        return # S3 already has the latest data
+    # Write venue location dictionary to csv file, which will not match S3
+    # until it has been uploaded
+    write_etag(venue_locations_file, None)
     write_dict_to_csv(venue_dict, venue_locations_file)
     # Upload new venue location data
     upload_venue_locations(s3, venue_locations_file)
+    updated_venues.clear()
 
 def main():
     """Try to find missing location data for all venues in S3 venue list"""
     # Temp directory for csv
     venue_locations_file = '/tmp/venue_locations.csv'
 
-    # Create client for interfacing with S3
-    s3 = create_client(aws_access_key_id, aws_secret_access_key)
-
-    # Get list of all unique venues from S3
-    venue_list = get_venue_list(s3)
-
     # Download existing venue location data csv
     download_venue_locations(s3, venue_locations_file)
 
     # Convert venue location data to a dictionary indexed by venue name
     venue_dict = read_csv_to_dict(venue_locations_file)
     
-    foursquare_available = True
+    # Send the Foursquare API version and keys with every request
+    foursquare_session.params = dict(v=time.strftime('%Y%m%d'),
+                                     client_id=foursquare_client_id,
+                                     client_secret=foursquare_client_secret)
+
+    # Names of venues that have changed since the last backup
+    updated_venues = set()
     time_at_last_backup = time.time()
     try: # Get data for each venue
-        for venue in venue_list:
-            already_slept = False
-            # venue[0] = venue name
-            # venue[1] = Untappd checkin link mentioning venue
-            # Check if new venue or venue is missing Untappd data
-            if venue[0] not in venue_dict or not venue_dict[venue[0]][0]:
+        # Find new venues and venues that are missing Untappd data while
+        # streaming the list of all unique venues from S3
+        # venue[0] = venue name
+        # venue[1] = Untappd checkin link mentioning venue
+        untappd_venues = [venue for venue in iter_venue_list(s3) if venue[0]
+                          not in venue_dict or not venue_dict[venue[0]][1]]
+        # Search Untappd for several venues at once so their requests overlap,
+        # the rate limiter keeps the combined request rate the same as searching
+        # one venue at a time
+        executor = ThreadPoolExecutor(max_workers=max_untappd_workers)
+        try:
+            futures = {executor.submit(search_untappd,
+                                       untappd_session,
+                                       venue[1]): venue[0]
+                       for venue in untappd_venues}
+            untappd_available = True
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                venue = futures[future]
                 # Get Untappd and Foursquare venue urls and venue coordinates
-                venue_dict[venue[0]] = [*search_untappd(venue[1]), '', '']
-                if not venue_dict[venue[0]][0]: # Untappd rejected request
-                    break # Stop script
-                # Sleep about 4 seconds to prevent Untappd rate limiting
-                time.sleep(4 + random.uniform(-1, 1))
-                already_slept = True # Set flag for Foursquare request
-            # Check if venue has Untappd data but is missing Foursquare data
-            if (foursquare_available and venue_dict[venue[0]][1]
-                and '' in venue_dict[venue[0]]):
-                # Get venue address, coordinates, categories, and in_us flag
-                venue_dict[venue[0]][-5:] = search_foursquare(venue[0],
-                                                venue_dict[venue[0]],
-                                                foursquare_client_id,
-                                                foursquare_client_secret)
-                if '' in venue_dict[venue[0]][-5:]:
-                    # Foursquare rejected request, stop searching Foursquare
-                    foursquare_available = False
-                if not already_slept: # Don't sleep if already slept for Untappd
-                    time.sleep(0.75) # Sleep to stay under hourly API call limit
+                venue_dict[venue] = [venue, *future.result(), '', '']
+                updated_venues.add(venue)
+                if untappd_available and not venue_dict[venue][1]:
+                    # Untappd rejected request, stop searching Untappd
+                    untappd_available = False
+                    for pending in futures:
+                        pending.cancel()
+                # Occasionally write data to database for large batches
+                # Lambda limits execution time to 15 minutes, backup every 14.75 min
+                if time.time() - time_at_last_backup >= 14 * 60 + 45:
+                    backup_data(s3, venue_dict, venue_locations_file,
+                                updated_venues)
+                    time_at_last_backup = time.time()
+        finally:
+            # Drop searches that have not started if the script is stopped
+            executor.shutdown(cancel_futures=True)
+
+        # Find venues that have Untappd data but are missing Foursquare data
+        foursquare_venues = [venue for venue, venue_data in venue_dict.items()
+                             if venue_data[2] and '' in venue_data]
+        for venue in foursquare_venues:
+            # Get venue address, coordinates, categories, and in_us flag
+            venue_dict[venue][-5:] = search_foursquare(foursquare_session,
+                                                       venue,
+                                                       venue_dict[venue])
+            updated_venues.add(venue)
+            if '' in venue_dict[venue][-5:]:
+                # Foursquare rejected request, stop searching Foursquare
+                break
+            if venue_dict[venue][2] != 'Missing': # No request without a url
+                time.sleep(0.75) # Sleep to stay under hourly API call limit
             # Occasionally write data to database for large batches
-            # Lambda limits execution time to 15 minutes, backup every 14.75 min
             if time.time() - time_at_last_backup >= 14 * 60 + 45:
-                backup_data(s3, venue_dict, venue_locations_file)
+                backup_data(s3, venue_dict, venue_locations_file, updated_venues)
                 time_at_last_backup = time.time()
     except KeyboardInterrupt:
         pass # Allow manually stopping script without losing data
 
     # Write updated data back to S3
-    backup_data(s3, venue_dict, venue_locations_file)
+    backup_data(s3, venue_dict, venue_locations_file, updated_venues)
 
 def lambda_handler(event, context):
     main()
@@ -6,21 +6,30 @@ saves it to an aggregate data file in csv format, and keeps track of unique
 venues that are mentioned in the posts
 
 Inputs:
+    last_parsed/{brewery}.json - config file for each brewery containing the
+        latest post that has been parsed for that brewery - do not manually
+        modify
     last_parsed.json - config file containing a dictionary mapping brewery
-        numbers to the latest post that has been parsed for that brewery - do
-        not manually modify
+        numbers to the latest post that has been parsed for that brewery, only
+        read for breweries that do not have their own config file yet - do not
+        manually modify
+    last_update.json - config file containing the latest post that has been
+        saved to the S3 bucket for each brewery - do not manually modify
     untappd_aggregate_data.csv - csv containing information from every post in
         the bucket parsed into labelled columns
-    venue_list.csv - list of all unique venues that are mentioned in posts
+    venue_list.csv - list of all unique venues that are mentioned in posts,
+        only read if venue_set.json does not exist yet
+    venue_set.json - json array of the names of every venue in venue_list.csv
     Post data organized by brewery number and post id in the S3 bucket
 
 Outputs:
-    last_parsed.json - config file containing a dictionary mapping brewery
-        numbers to the latest post that has been parsed for that brewery - do
-        not manually modify
+    last_parsed/{brewery}.json - config file for each brewery containing the
+        latest post that has been parsed for that brewery - do not manually
+        modify
     untappd_aggregate_data.csv - csv containing information from every post in
         the bucket parsed into labelled columns
     venue_list.csv - list of all unique venues that are mentioned in posts
+    venue_set.json - json array of the names of every venue in venue_list.csv
 
 Environment Variables:
     untappd_access_key_id - access key for AWS user
@@ -36,9 +45,14 @@ Automatic Triggering:
 __author__ = "Dallan Goldblatt"
 
 import boto3
+import codecs
 import csv
+import io
 import json
 import os
+import re
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 
 # Get environment variables
 untappd_access_key_id = os.environ['untappd_access_key_id']
@@ -46,61 +60,175 @@ untappd_secret_access_key = os.environ['untappd_secret_access_key']
 untappd_breweries = os.environ['untappd_breweries'].split(',')
 untappd_bucket = os.environ['untappd_bucket']
 
+# Maximum number of posts that are downloaded from S3 at once
+max_post_workers = 32
+
+# S3 only accepts an existing object as a copied multipart upload part if it is
+# at least 5 MB, smaller objects are rewritten in full instead
+min_copy_part_size = 5 * 1024 * 1024
+
+# Beer names that contain ' at ', matched without building a lowercased title
+beer_exception_re = re.compile(r'victory at sea|murder at schrute farm\.\.\.death by fire',
+                               re.IGNORECASE)
+
+# Brewery number and post id from a post's object name, and username from a
+# post's link, each taken in one pass over the string
+# Examples: '68/68-756802330' and
+# 'https://untappd.com/user/Mckman007/checkin/756802330'
+post_key_re = re.compile(r'^(\d+)/\d+-(\d+)$')
+user_link_re = re.compile(r'/user/([^/]+)/')
+
 def create_client(access_key_id, secret_access_key):
     """Create S3 client for later use"""
+    # Allow enough connections for the threads downloading posts and files
+    # and keep idle connections open between invocations
+    config = Config(max_pool_connections=64, tcp_keepalive=True)
     client = boto3.client('s3',
                           aws_access_key_id=access_key_id,
-                          aws_secret_access_key=secret_access_key)
+                          aws_secret_access_key=secret_access_key,
+                          config=config)
     return client
 
-def download_parsed_data(client, file):
-    """Download exisiting parsed data"""
-    # S3 does not support appending to objects in place
-    client.download_file(Bucket=untappd_bucket,
-                         Key='untappd_aggregate_data.csv',
-                         Filename=file)
-
-def upload_parsed_data(client, file):
-    """Upload parsed data file to S3"""
-    # S3 does not support appending to objects in place
-    client.upload_file(Bucket=untappd_bucket,
-                       Key='untappd_aggregate_data.csv',
-                       Filename=file)
-
-def download_venue_list(client, file):
-    """Download existing csv containing venue names"""
-    # S3 does not support appending to objects in place
-    client.download_file(Bucket=untappd_bucket,
-                         Key='venue_list.csv',
-                         Filename=file)
-
-def upload_venue_list(client, file):
-    """Upload venue csv file to S3"""
-    # S3 does not support appending to objects in place
-    client.upload_file(Bucket=untappd_bucket,
-                       Key='venue_list.csv',
-                       Filename=file)
+# Client for interfacing with S3, kept between invocations of a warm Lambda
+# container so its connections and setup are reused
+s3 = create_client(untappd_access_key_id, untappd_secret_access_key)
+
+def append_to_object(client, key, data):
+    """Append bytes to the end of an existing object in S3"""
+    # S3 does not support appending to objects in place, so a new object is
+    # built from a server-side copy of the existing object followed by the new
+    # data without downloading the existing object
+    head = client.head_object(Bucket=untappd_bucket, Key=key)
+    if head['ContentLength'] < min_copy_part_size:
+        # Object is too small to be copied as a part, rewrite it in full
+        body = client.get_object(Bucket=untappd_bucket,
+                                 Key=key,
+                                 IfMatch=head['ETag'])['Body'].read()
+        client.put_object(Bucket=untappd_bucket, Key=key, Body=body + data)
+        return
+    upload_id = client.create_multipart_upload(Bucket=untappd_bucket,
+                                               Key=key)['UploadId']
+    try:
+        # Copy the existing object as the first part, failing if it changed
+        # since its size was checked
+        copied = client.upload_part_copy(Bucket=untappd_bucket,
+                                         Key=key,
+                                         CopySource={'Bucket': untappd_bucket,
+                                                     'Key': key},
+                                         CopySourceIfMatch=head['ETag'],
+                                         PartNumber=1,
+                                         UploadId=upload_id)
+        # The last part has no minimum size
+        uploaded = client.upload_part(Bucket=untappd_bucket,
+                                      Key=key,
+                                      Body=data,
+                                      PartNumber=2,
+                                      UploadId=upload_id)
+        parts = [{'ETag': copied['CopyPartResult']['ETag'], 'PartNumber': 1},
+                 {'ETag': uploaded['ETag'], 'PartNumber': 2}]
+        client.complete_multipart_upload(Bucket=untappd_bucket,
+                                         Key=key,
+                                         MultipartUpload={'Parts': parts},
+                                         UploadId=upload_id)
+    except Exception:
+        # Don't leave the unfinished upload's parts stored in the bucket
+        client.abort_multipart_upload(Bucket=untappd_bucket,
+                                      Key=key,
+                                      UploadId=upload_id)
+        raise
+
+def get_venue_set(client):
+    """Read S3 file containing the names of all venues in the venue list, also
+    returning whether the file exists"""
+    try:
+        f = client.get_object(Bucket=untappd_bucket,
+                              Key='venue_set.json')['Body']
+    except client.exceptions.NoSuchKey:
+        # Build the set from the venue list csv the first time
+        f = client.get_object(Bucket=untappd_bucket,
+                              Key='venue_list.csv')['Body']
+        data = csv.reader(codecs.getreader('utf-8')(f))
+        next(data) # skip headers
+        return {row[0] for row in data if row}, False
+    # f is a StreamingBody object in json, load to retrieve list of venues
+    return set(json.loads(f.read())), True
+
+def set_venue_set(client, venue_set):
+    """Write names of all venues in the venue list to S3"""
+    json_body = json.dumps(sorted(venue_set), separators=(',', ':'))
+    client.put_object(ACL='private',
+                      Bucket=untappd_bucket,
+                      Key='venue_set.json',
+                      Body=json_body)
+
+def get_last_parsed_id(client, brewery):
+    """Read S3 file containing most recently parsed post id for a brewery"""
+    try:
+        f = client.get_object(Bucket=untappd_bucket,
+                              Key=f'last_parsed/{brewery}.json')['Body']
+    except client.exceptions.NoSuchKey:
+        return None
+    # f is a StreamingBody object in json, load to retrieve id number
+    return json.loads(f.read())['id']
+
+def get_legacy_last_parsed_ids(client):
+    """Read S3 file containing most recently parsed post ids for all breweries
+    that was used before each brewery had its own file"""
+    try:
+        f = client.get_object(Bucket=untappd_bucket,
+                              Key='last_parsed.json')['Body']
+    except client.exceptions.NoSuchKey:
+        return {}
+    # f is a StreamingBody object in json, load to retrieve id number dictionary
+    return json.loads(f.read())
 
 def get_last_parsed_ids(client, breweries):
-    """Read S3 file containing most recently parsed post ids for each brewery"""
+    """Read S3 files containing most recently parsed post ids for each brewery"""
+    # Read the files for several breweries at once, within the S3 client's
+    # connection pool
+    with ThreadPoolExecutor(max_workers=min(len(breweries),
+                                            max_post_workers)) as executor:
+        ids = dict(zip(breweries,
+                       executor.map(lambda brewery: get_last_parsed_id(client, brewery),
+                                    breweries)))
+    if None in ids.values():
+        # Fall back to the single file for breweries without their own file,
+        # handling missing keys resulting from when a new brewery is added
+        legacy_ids = get_legacy_last_parsed_ids(client)
+        for brewery, id in ids.items():
+            if id is None:
+                ids[brewery] = legacy_ids.get(brewery, '')
+    return ids
+
+def get_latest_post_ids(client):
+    """Read S3 file containing most recently saved post ids for each brewery"""
     f = client.get_object(Bucket=untappd_bucket,
-                          Key='last_parsed.json')['Body']
+                          Key='last_update.json')['Body']
     # f is a StreamingBody object in json, load to retrieve id number dictionary
-    ids = json.load(f);
-    # Handle missing keys resulting from when a new brewery is added
-    for brewery in breweries:
-        if brewery not in ids:
-            ids[brewery] = ''
-    return ids
+    # Handle missing brewery ids from before they were stored
+    return json.loads(f.read()).get('breweries', {})
 
-def set_last_parsed_ids(client, ids):
-    """Write most recently parsed post ids for each brewery to S3"""
-    json_body = json.dumps(ids)
+def set_last_parsed_id(client, brewery, id):
+    """Write most recently parsed post id for a brewery to S3"""
+    # json format is used in case more key-value pairs need to be stored
+    body = {'id': id}
+    json_body = json.dumps(body, separators=(',', ':'))
     client.put_object(ACL='private',
                       Bucket=untappd_bucket,
-                      Key='last_parsed.json',
+                      Key=f'last_parsed/{brewery}.json',
                       Body=json_body)
 
+def set_last_parsed_ids(client, ids):
+    """Write most recently parsed post ids for each brewery to S3"""
+    if not ids:
+        return # No ids changed
+    # Write the files for several breweries at once, within the S3 client's
+    # connection pool
+    with ThreadPoolExecutor(max_workers=min(len(ids),
+                                            max_post_workers)) as executor:
+        list(executor.map(lambda item: set_last_parsed_id(client, *item),
+                          ids.items()))
+
 def get_next_post_ids(client, brewery, start):
     """Get object names in S3 of up to 1000 unparsed posts for a brewery"""
     # Construct object name of starting post (ordered by last modified FIFO)
@@ -123,17 +251,18 @@ def parse_post(client, post_id):
     """Parse passed post into list of attributes"""
     # Get post from S3
     f = client.get_object(Bucket=untappd_bucket, Key=post_id)['Body']
-    # f is a StreamingBody object in json, load to retrieve post data
-    post = json.load(f)
+    # f is a StreamingBody object in json, read the whole body at once and
+    # load to retrieve post data
+    post = json.loads(f.read())
+    brewery, guid = post_key_re.match(post_id).groups()
     # Construct list that will become a row in the csv
-    row = [int(post_id.split('-')[-1])] # guid
-    row.append(post['link'].split('/')[-3]) # username
-    row.append(post_id.split('/')[0]) # brewery
+    row = [int(guid)] # guid
+    row.append(user_link_re.search(post['link']).group(1)) # username
+    row.append(brewery) # brewery
     # Get title containing beer and location/venue name
     title = post['title']
     # Handle special case when beer name contains 'at'
-    beer_ex_list = ['victory at sea', 'murder at schrute farm...death by fire']
-    loc_idx = 2 if any(sbstr in title.lower() for sbstr in beer_ex_list) else 1
+    loc_idx = 2 if beer_exception_re.search(title) else 1
     s = split(title, ' at ', loc_idx) # extract location if it exists
     y = s[0].split(' is drinking ') # extract beer name
     row.append(y[1].split(' ', 1)[1]) # beer name
@@ -160,75 +289,85 @@ def parse_post(client, post_id):
     row.append(post['link']) # url
     return row
 
-def append_to_csv(file, rows):
-    """Append list of rows to existing csv"""
-    with open(file, "a", newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerows(rows)
-
-def append_to_venues(venue_file, rows):
-    """Append new venues to file containing existing list of venues"""
-    # Read file containing list of existing venues
-    with open(venue_file, "r", encoding='utf-8') as f:
-        data = csv.reader(f)
-        next(data) # skip headers
-        venue_list = [row[0] for row in list(data)] # get list of venues only
-    
-    # Get list of new venues and urls from new rows, ignoring rows with no venue
-    new_venues = [[row[4], row[8]] for row in rows if row[4] != '']
-    # Compare lists, ignoring duplicates in both existing list and appended list
-    new_rows = []
-    new_venue_names = []
-    for venue in new_venues:
-        if venue[0] not in venue_list and venue[0] not in new_venue_names:
-            new_rows.append(venue)
-            new_venue_names.append(venue[0])
-
-    # Append new venues to csv
-    with open(venue_file, "a", newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerows(new_rows)
+def write_rows_to_bytes(rows):
+    """Write list of rows to csv formatted bytes that can be appended to a csv"""
+    # Encode rows straight into a byte buffer instead of building a string and
+    # encoding a second copy of it
+    buffer = io.BytesIO()
+    f = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+    writer = csv.writer(f)
+    writer.writerows(rows)
+    # Flush and detach the text wrapper so the buffer stays open for reading
+    f.detach()
+    return buffer.getvalue()
+
+def get_new_venues(venue_set, rows):
+    """Get new venues and urls from new rows, adding them to set of venues"""
+    new_venues = []
+    for row in rows:
+        # Ignore rows with no venue and duplicates in both the existing venues
+        # and the new rows
+        if row[4] != '' and row[4] not in venue_set:
+            venue_set.add(row[4])
+            new_venues.append([row[4], row[8]])
+    return new_venues
 
 def main():
     """Get and handle all new posts in S3 bucket"""
-    # Temp directory for csvs
-    csv_file = '/tmp/data.csv'
-    venue_file = '/tmp/venue_list.csv'
-
-    # Create client for interfacing with S3
-    s3 = create_client(untappd_access_key_id, untappd_secret_access_key)
-
     # Get ids of latest posts that have already been added to the csv
     last_parsed_ids = get_last_parsed_ids(s3, untappd_breweries)
+    # Keep the ids that were read so only changed ids are written back
+    previous_parsed_ids = dict(last_parsed_ids)
+    # Get ids of latest posts that have been saved to the bucket
+    latest_post_ids = get_latest_post_ids(s3)
 
     # Generate new rows to add to csv for each brewery
     rows = []
-    for brewery in untappd_breweries:
-        # Parse all new posts for brewery, up to 1000 posts at a time
-        while True:
+    with ThreadPoolExecutor(max_workers=max_post_workers) as executor:
+        for brewery in untappd_breweries:
+            # Skip listing posts if the latest saved post is already parsed
+            if str(latest_post_ids.get(brewery)) == last_parsed_ids[brewery]:
+                continue
             next_post_ids = get_next_post_ids(s3,
                                               brewery,
                                               last_parsed_ids[brewery])
-            # Jump to next brewery if no new posts remain
-            if not next_post_ids:
-                break;
-            for obj in next_post_ids:
-                rows.append(parse_post(s3, obj['Key']))
-                last_parsed_ids[brewery] = obj['Key'].split('-')[-1]
+            # Parse all new posts for brewery, up to 1000 posts at a time,
+            # jumping to next brewery if no new posts remain
+            while next_post_ids:
+                # Posts are listed in order, so the last one is the latest
+                last_post_id = next_post_ids[-1]['Key'].rpartition('-')[2]
+                # List the next posts while these posts are parsed, submitted
+                # first so the listing is not queued behind the posts
+                next_page = executor.submit(get_next_post_ids,
+                                            s3,
+                                            brewery,
+                                            last_post_id)
+                # Get posts from S3 concurrently, results are kept in order
+                rows.extend(executor.map(lambda obj: parse_post(s3, obj['Key']),
+                                         next_post_ids))
+                last_parsed_ids[brewery] = last_post_id
+                next_post_ids = next_page.result()
 
     if rows:
-        # Download csvs with existing data
-        download_parsed_data(s3, csv_file)
-        download_venue_list(s3, venue_file)
-
-        # Append new rows to existing data files
-        append_to_csv(csv_file, rows)
-        append_to_venues(venue_file, rows)
-
-        # Upload finished data
-        upload_parsed_data(s3, csv_file)
-        upload_venue_list(s3, venue_file)
-        set_last_parsed_ids(s3, last_parsed_ids)
+        # Append new rows to the end of the existing data in S3
+        append_to_object(s3, 'untappd_aggregate_data.csv',
+                         write_rows_to_bytes(rows))
+
+        # Find venues that are not in the venue list yet
+        venue_set, venue_set_exists = get_venue_set(s3)
+        new_venues = get_new_venues(venue_set, rows)
+
+        if new_venues:
+            # Append new venues to the existing venue list in S3
+            append_to_object(s3, 'venue_list.csv',
+                             write_rows_to_bytes(new_venues))
+        if new_venues or not venue_set_exists:
+            # Save the set, including when it was just built from the csv so
+            # the csv is not read again
+            set_venue_set(s3, venue_set)
+        set_last_parsed_ids(s3, {brewery: id
+                                 for brewery, id in last_parsed_ids.items()
+                                 if id != previous_parsed_ids[brewery]})
 
 def lambda_handler(event, context):
     main()
@@ -7,11 +7,13 @@ Example RSS feed url (Ballast Point): https://untappd.com/rss/brewery/68
 
 Inputs:
     last_update.json - config file containing the latest post from the Untappd
-        website that has been saved to the S3 bucket - do not manually modify
+        website that has been saved to the S3 bucket, overall and for each
+        brewery - do not manually modify
 
 Outputs:
     last_update.json - config file containing the latest post from the Untappd
-        website that has been saved to the S3 bucket - do not manually modify
+        website that has been saved to the S3 bucket, overall and for each
+        brewery - do not manually modify
     Post data organized by brewery number and post id in S3 bucket (json format)
 
 Environment Variables:
@@ -28,9 +30,14 @@ Automatic Triggering:
 __author__ = "Dallan Goldblatt"
 
 import boto3
-import feedparser
+import itertools
 import json
+import http.client
 import os
+import urllib.request
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
 
 # Get environment variables
 untappd_access_key_id = os.environ['untappd_access_key_id']
@@ -38,49 +45,98 @@ untappd_secret_access_key = os.environ['untappd_secret_access_key']
 untappd_breweries = os.environ['untappd_breweries']
 untappd_bucket = os.environ['untappd_bucket']
 
+# Maximum number of posts that are written to S3 at once
+max_post_workers = 16
+
+# Seconds to wait on an RSS feed before skipping it until the next call
+feed_timeout = 10
+
+# Identify the feed reader instead of sending urllib's default user agent
+feed_headers = {'User-Agent': 'untappd-data RSS reader'}
+
 def create_client(access_key_id, secret_access_key):
     """Create S3 client for later use"""
+    # Allow a connection for each thread writing posts, retry throttled
+    # requests with adaptive backoff, and keep idle connections open between
+    # invocations
+    config = Config(max_pool_connections=32,
+                    retries={'max_attempts': 3, 'mode': 'adaptive'},
+                    tcp_keepalive=True)
     client = boto3.client('s3',
                           aws_access_key_id=access_key_id,
-                          aws_secret_access_key=secret_access_key)
+                          aws_secret_access_key=secret_access_key,
+                          config=config)
     return client
 
+# Client for interfacing with S3, kept between invocations of a warm Lambda
+# container so its connections and setup are reused
+s3 = create_client(untappd_access_key_id, untappd_secret_access_key)
+
 def get_posts(url):
     """Get 25 posts from the RSS feed for a specific brewery"""
-    feed = feedparser.parse(url)
-    return feed.entries
+    request = urllib.request.Request(url, headers=feed_headers)
+    try:
+        # urlopen raises an HTTPError for error status codes
+        with urllib.request.urlopen(request, timeout=feed_timeout) as resp:
+            root = ElementTree.fromstring(resp.read())
+    except (OSError, http.client.HTTPException, ElementTree.ParseError) as e:
+        # Skip the feed until the next function call
+        print('RSS feed request failed:\n\t', e)
+        return []
+    # Keep the fields of each item that are used to save and parse posts, named
+    # the same way as in the posts already saved in the bucket
+    # Strip whitespace around the text so fields spanning lines in the feed
+    # match the posts saved before
+    return [{'id': item.findtext('guid', '').strip(),
+             'title': item.findtext('title', '').strip(),
+             'link': item.findtext('link', '').strip(),
+             'summary': item.findtext('description', '').strip(),
+             'published': item.findtext('pubDate', '').strip(),
+             'title_detail': {'base': url}}
+            for item in root.iterfind('channel/item')]
 
 def get_all_posts(breweries):
     """Get all posts from the RSS feeds for all breweries"""
-    posts = []
-    for brewery in breweries:
-        posts += get_posts(f'https://untappd.com/rss/brewery/{brewery}')
-    return posts
-
-def get_last_update_id(client):
-    """Read last_update.json in the S3 database to get most recent post"""
-    f = client.get_object(Bucket=,
+    urls = [f'https://untappd.com/rss/brewery/{brewery}' for brewery in breweries]
+    # Download all feeds at once since each request spends most of its time
+    # waiting on Untappd
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        feeds = executor.map(get_posts, urls)
+        return list(itertools.chain.from_iterable(feeds))
+
+def get_last_update(client):
+    """Read last_update.json in the S3 database to get most recent post overall
+    and for each brewery"""
+    f = client.get_object(Bucket=untappd_bucket,
                           Key='last_update.json')['Body']
-    # f is a StreamingBody object in json, load to retrieve id number
-    return json.load(f)['id']
-
-def set_last_update_id(client, id):
-    """Write most recent post id to last_update.json in S3 database"""
-    # json format is used in case more key-value pairs need to be stored
-    body = {'id': id}
-    json_body = json.dumps(body)
+    # f is a StreamingBody object in json, load to retrieve id numbers
+    body = json.loads(f.read())
+    # Handle missing brewery ids from before they were stored
+    body.setdefault('breweries', {})
+    return body
+
+def set_last_update(client, id, brewery_ids):
+    """Write most recent post id overall and for each brewery to
+    last_update.json in S3 database"""
+    # The brewery ids let the parse function skip breweries without new posts
+    body = {'id': id, 'breweries': brewery_ids}
+    json_body = json.dumps(body, separators=(',', ':'))
     client.put_object(ACL='private',
                       Bucket=untappd_bucket,
                       Key='last_update.json',
                       Body=json_body)
 
-def write_post_to_s3(client, post, post_id):
-    """Write an entire post to the S3 database"""
-    # Convert post to json
-    json_body = json.dumps(post)
-    # Get unique brewery id (assigned by Untappd) from post
+def get_brewery_id(post):
+    """Get unique brewery id (assigned by Untappd) from post"""
     # Example: https://untappd.com/rss/brewery/68 has brewery id 68
-    brewery_id = post['title_detail']['base'].rsplit('/', 1)[-1]
+    return post['title_detail']['base'].rsplit('/', 1)[-1]
+
+def write_post_to_s3(client, post, post_id):
+    """Write the fields of a post that are kept from its RSS item to the S3
+    database"""
+    # Convert post to json, without whitespace between items
+    json_body = json.dumps(post, separators=(',', ':'))
+    brewery_id = get_brewery_id(post)
     # Construct key for object using brewery id and post id
     post_key = f"{brewery_id}/{brewery_id}-{post_id}"
     client.put_object(ACL='private',
@@ -90,18 +146,19 @@ def write_post_to_s3(client, post, post_id):
 
 def main():
     """Get and handle all new posts on Untappd"""
-    # Create client for interfacing with S3
-    s3 = create_client(untappd_access_key_id, untappd_secret_access_key)
-
     # Get id of the latest post that was handled in the previous function call
-    last_update_id = get_last_update_id(s3)
+    last_update = get_last_update(s3)
+    last_update_id = last_update['id']
     # Set inital value for lastest post handled by this function call
     most_recent_id = last_update_id
+    # Latest post handled for each brewery, kept for breweries without new posts
+    brewery_ids = last_update['breweries']
 
     # Get list of all posts from all breweries specified by env variable
     posts = get_all_posts(untappd_breweries.split(','))
 
-    # Iterate over all posts and write new posts to the database
+    # Find new posts that need to be written to the database
+    new_posts = []
     for post in posts:
         # Get unique post id number from post
         # Example: 'https://untappd.com/user/Mckman007/checkin/756802330'
@@ -109,12 +166,23 @@ def main():
         post_id = int(post['id'].rsplit('/', 1)[-1])
         # if post_id is greater than last_update_id, post is not yet in database
         if(post_id > last_update_id):
-            most_recent_id = max(most_recent_id, post_id)
-            write_post_to_s3(s3, post, post_id)
+            new_posts.append((post, post_id))
+
+    if new_posts:
+        # Order new posts by id once so the last post is the most recent, both
+        # overall and for each brewery
+        new_posts.sort(key=lambda new_post: new_post[1])
+        most_recent_id = new_posts[-1][1]
+        for post, post_id in new_posts:
+            brewery_ids[get_brewery_id(post)] = post_id
+        # Write new posts to the database concurrently
+        with ThreadPoolExecutor(max_workers=max_post_workers) as executor:
+            list(executor.map(lambda new_post: write_post_to_s3(s3, *new_post),
+                              new_posts))
 
     # After all new posts have been written to database, set last_update_id
-    # for next function call
-    set_last_update_id(s3, most_recent_id)
+    # and brewery ids for next function call
+    set_last_update(s3, most_recent_id, brewery_ids)
 
 def lambda_handler(event, context):
     main()